@@ -0,0 +1,53 @@
+"""micro-benchmark of the timestamp conversion paths used when building entities
+
+run with `python bench_parse_time.py`"""
+import timeit
+
+import influxdbds
+
+ROWS = 10000
+REPEAT = 5
+# a page of grouped results: 100 distinct timestamps, each repeated for 100 tag sets
+TIMES = ['2017-01-01T00:{:02d}:{:02d}.{:09d}Z'.format(i // 60 % 60, i % 60, i * 1234567)
+         for i in range(ROWS // 100)] * 100
+DISTINCT_TIMES = ['2017-01-01T{:02d}:{:02d}:{:02d}.{:09d}Z'.format(i // 3600 % 24, i // 60 % 60, i % 60, i * 1234567)
+                  for i in range(ROWS)]
+EPOCH_TIMES = [1483228800000000000 + i * 1000000123 for i in range(ROWS)]
+
+
+def strptime_path(times):
+    for t in times:
+        influxdbds._strptime_influxdb_time(t)
+
+
+def fast_path(times):
+    for t in times:
+        influxdbds._parse_rfc3339(t)
+
+
+def memo_path(times):
+    influxdbds._parsed_times.clear()
+    for t in times:
+        influxdbds.parse_influxdb_time(t)
+
+
+def epoch_path(times):
+    for t in times:
+        influxdbds.parse_influxdb_epoch(t)
+
+
+def main():
+    cases = [
+        ('strptime (previous implementation)', strptime_path, DISTINCT_TIMES),
+        ('fast RFC3339 parser', fast_path, DISTINCT_TIMES),
+        ('parse_influxdb_time, distinct times', memo_path, DISTINCT_TIMES),
+        ('parse_influxdb_time, repeated times', memo_path, TIMES),
+        ('parse_influxdb_epoch (epoch=ns)', epoch_path, EPOCH_TIMES),
+    ]
+    for name, func, times in cases:
+        best = min(timeit.repeat(lambda: func(times), number=1, repeat=REPEAT))
+        print('{:<40} {:8.3f} us/row'.format(name, best / len(times) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+"""load test of the OData endpoint against a fake InfluxDB
+
+a stand-in for InfluxDB's /query endpoint runs in a separate process and answers with synthetic points,
+the OData app from `server.configure_app` is served by the threaded wsgiserver, and concurrent clients
+request each scenario. requests/s, p50/p99 latency and the peak RSS of the OData process are reported.
+
+run with `python bench_server.py` (see `--help`), ex.
+`python bench_server.py --rows 100000 --series 50 --latency 5 --clients 8 --option influxdb.cache_ttl=10`"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import re
+import resource
+import threading
+import time
+import urllib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing import Process, Queue
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs, urlparse
+
+import requests
+
+from influxql import parse_influxdb_duration
+from server import CompressionMiddleware, ReloadableApp, configure_app, get_sample_config, load_metadata
+from wsgiserver import make_server
+
+# the fake measurement matches database1__measurement1 in test_data/test_metadata.xml
+METADATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data', 'test_metadata.xml')
+ENTITY_SET = '/database1__measurement1'
+START = datetime.datetime(2017, 1, 1)
+FIELDS = ['float_field', 'int_field']
+TAGS = ['tag1', 'tag2']
+
+SCENARIOS = {
+    'raw': lambda args: '{}?$top={}'.format(ENTITY_SET, args.page_size),
+    'paged': lambda args: '{}?$top={}'.format(ENTITY_SET, args.page_size // 10 or 1),
+    'filtered': lambda args: '{}?$top={}&$filter={}'.format(
+        ENTITY_SET, args.page_size, urllib.quote("tag1 eq 'host1' and timestamp ge datetime'2017-01-01T00:00:00'")),
+    'aggregated': lambda args: '{}?aggregate=mean&groupByTime=1m&$filter={}'.format(
+        ENTITY_SET, urllib.quote("timestamp ge datetime'2017-01-01T00:00:00' and "
+                                 "timestamp lt datetime'{}'".format((START + datetime.timedelta(
+                                     seconds=args.rows)).strftime('%Y-%m-%dT%H:%M:%S')))),
+}
+# pages followed through their next links in the paged scenario
+PAGES = 10
+
+
+class FakeInfluxDB(object):
+    """answers influxql queries from the OData server with synthetic points
+
+    there is one point a second from START, spread over series values of tag1. only the parts of a query
+    the OData server relies on are understood: SHOW FIELD/TAG KEYS, COUNT, aggregates with GROUP BY time,
+    tag1 equality and LIMIT/OFFSET"""
+    def __init__(self, rows, series, latency):
+        self.latency = latency
+        self.points = [(i, 'host{}'.format(i % series), 'region{}'.format(i % 4), i * 0.5, i % 1000)
+                       for i in range(rows)]
+
+    def query(self, q, epoch):
+        time.sleep(self.latency)
+        return {'results': [dict(self.statement(statement.strip(), epoch), statement_id=i)
+                            for i, statement in enumerate(q.split(';'))]}
+
+    def statement(self, q, epoch):
+        if q.startswith('SHOW FIELD KEYS'):
+            return self.series(['fieldKey', 'fieldType'], [[f, 'float' if f == 'float_field' else 'integer']
+                                                         for f in FIELDS])
+        if q.startswith('SHOW TAG KEYS'):
+            return self.series(['tagKey'], [[t] for t in TAGS])
+        points = self.points
+        match = re.search(r""""tag1" = '([^']*)'""", q)
+        if match:
+            points = [p for p in points if p[1] == match.group(1)]
+        match = re.search(r'GROUP BY time\((\w+)\)', q)
+        if match:
+            points = self.buckets(points, parse_influxdb_duration(match.group(1)).total_seconds())
+        func = re.match(r'SELECT (\w+)\(', q)
+        if func and not match:
+            return self.series(['time'] + ['{}_{}'.format(func.group(1).lower(), f) for f in FIELDS],
+                               [[self.time(0, epoch)] + [len(points)] * len(FIELDS)])
+        offset = re.search(r'OFFSET (\d+)', q)
+        limit = re.search(r'LIMIT (\d+)', q)
+        start = int(offset.group(1)) if offset else 0
+        points = points[start:start + int(limit.group(1)) if limit else None]
+        if func:
+            return self.series(['time'] + ['{}_{}'.format(func.group(1).lower(), f) for f in FIELDS],
+                               [[self.time(t, epoch), count, count] for t, count in points])
+        return self.series(['time'] + TAGS + FIELDS, [[self.time(p[0], epoch)] + list(p[1:]) for p in points])
+
+    def buckets(self, points, seconds):
+        counts = {}
+        for p in points:
+            bucket = int(p[0] // seconds * seconds)
+            counts[bucket] = counts.get(bucket, 0) + 1
+        return sorted(counts.items())
+
+    def time(self, seconds, epoch):
+        if epoch:
+            return int((START - datetime.datetime(1970, 1, 1)).total_seconds() + seconds) * 1000000000
+        return (START + datetime.timedelta(seconds=seconds)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def series(self, columns, values):
+        if not values:
+            return {}
+        return {'series': [{'name': 'measurement1', 'columns': columns, 'values': values}]}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def run_fake_influxdb(rows, series, latency, port_queue):
+    influxdb = FakeInfluxDB(rows, series, latency)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            args = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+            body = json.dumps(influxdb.query(args.get('q', ''), args.get('epoch')))
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100.0))]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_scenario(base_url, path, clients, requests_per_client, follow_next=False):
+    """returns (latencies in seconds, number of errors, elapsed seconds)"""
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+
+    def client():
+        with requests.Session() as session:
+            # next links don't keep $format, so ask for json with Accept
+            session.headers['Accept'] = 'application/json'
+            for i in range(requests_per_client):
+                url = base_url + path
+                for page in range(PAGES if follow_next else 1):
+                    t = time.time()
+                    resp = session.get(url)
+                    elapsed = time.time() - t
+                    with lock:
+                        if resp.status_code != 200:
+                            errors[0] += 1
+                            break
+                        latencies.append(elapsed)
+                    if not follow_next:
+                        break
+                    url = resp.json()['d'].get('__next', {}).get('uri')
+                    if url is None:
+                        break
+
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sorted(latencies), errors[0], time.time() - start
+
+
+def main():
+    p = argparse.ArgumentParser(description='load test the OData endpoint against a fake InfluxDB')
+    p.add_argument('--rows', type=int, default=20000, help='points in the fake measurement')
+    p.add_argument('--series', type=int, default=10, help='distinct values of tag1 (series cardinality)')
+    p.add_argument('--latency', type=float, default=0, help='milliseconds the fake InfluxDB waits before answering')
+    p.add_argument('--clients', type=int, default=4, help='concurrent OData clients')
+    p.add_argument('--requests', type=int, default=20, help='requests per client for each scenario')
+    p.add_argument('--page-size', type=int, default=1000, help='$top of the raw and filtered scenarios')
+    p.add_argument('--worker-threads', type=int, default=8, help='worker threads of the OData server')
+    p.add_argument('--scenarios', default='raw,paged,filtered,aggregated',
+                   help='comma separated scenarios to run, from {}'.format(', '.join(sorted(SCENARIOS))))
+    p.add_argument('--option', action='append', default=[],
+                   help='config option for the OData server, as section.name=value (can be repeated)')
+    args = p.parse_args()
+
+    port_queue = Queue()
+    influxdb = Process(target=run_fake_influxdb, args=(args.rows, args.series, args.latency / 1000.0, port_queue))
+    influxdb.daemon = True
+    influxdb.start()
+    influxdb_port = port_queue.get()
+
+    c = get_sample_config()
+    c.set('influxdb', 'dsn', 'influxdb://127.0.0.1:{}'.format(influxdb_port))
+    c.set('influxdb', 'max_items_per_query', str(max(args.page_size, 50)))
+    c.set('metadata', 'autogenerate', 'no')
+    c.set('metadata', 'metadata_file', METADATA_FILE)
+    for option in args.option:
+        name, _, value = option.partition('=')
+        section, _, key = name.partition('.')
+        c.set(section, key, value)
+    # benchmark the request path, not the log handler
+    logging.getLogger('odata-influxdb').setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    app = ReloadableApp(None)
+    server = make_server('127.0.0.1', 0, app, worker_threads=args.worker_threads)
+    # the next links of the paged scenario must point at the port we got
+    c.set('server', 'service_advertise_root', 'http://127.0.0.1:{}'.format(server.port))
+    app.app = configure_app(c, load_metadata(c))
+    if c.getboolean('server', 'compression'):
+        app.app = CompressionMiddleware(app.app, level=c.getint('server', 'compression_level'),
+                                        min_size=c.getint('server', 'compression_min_size'))
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    base_url = 'http://127.0.0.1:{}'.format(server.port)
+
+    print('{} rows, {} series, {:g}ms influxdb latency, {} clients x {} requests'.format(
+        args.rows, args.series, args.latency, args.clients, args.requests))
+    print('{:<12} {:>8} {:>7} {:>9} {:>9} {:>9} {:>13}'.format(
+        'scenario', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms', 'peak RSS MB'))
+    try:
+        for name in args.scenarios.split(','):
+            latencies, errors, elapsed = run_scenario(base_url, SCENARIOS[name](args), args.clients,
+                                                      args.requests, follow_next=name == 'paged')
+            print('{:<12} {:>8} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>13.1f}'.format(
+                name, len(latencies), errors, len(latencies) / elapsed, percentile(latencies, 50) * 1000,
+                percentile(latencies, 99) * 1000, peak_rss_mb()))
+    finally:
+        server.shutdown()
+        influxdb.terminate()
+
+
+if __name__ == '__main__':
+    main()
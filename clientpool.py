@@ -0,0 +1,176 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import influxdb
+
+from metrics import metrics
+
+logger = logging.getLogger("odata-influxdb")
+
+
+class PoolTimeout(Exception):
+    """no client was returned to an `InfluxDBClientPool` within its checkout_timeout"""
+    pass
+
+
+class TimedInfluxDBClient(influxdb.InfluxDBClient):
+    """InfluxDBClient that records its queries, the time spent waiting for influxdb and decoding its json,
+    and the bytes received (of responses that are not streamed), in `metrics`"""
+    def request(self, *args, **kwargs):
+        with metrics.timer('influxdb_request'):
+            response = super(TimedInfluxDBClient, self).request(*args, **kwargs)
+        metrics.inc('queries_total')
+        if not kwargs.get('stream'):
+            metrics.inc('bytes_received_total', len(response.content))
+            decode = response.json
+
+            def timed_json(**kwargs):
+                with metrics.timer('json_decode'):
+                    return decode(**kwargs)
+            response.json = timed_json
+        return response
+
+
+class InfluxDBClientPool(object):
+    """Pool of InfluxDBClients, kept separately for each set of credentials
+
+    Every InfluxDBClient has its own keep-alive http session, and a client is only used
+    by one request at a time, so requests with different credentials never share a client
+    (or its switch_user state) and run in parallel.
+
+    dsn
+        data source name used to create the clients, its user:pass are the default credentials
+
+    max_clients
+        maximum number of clients for each set of credentials. checkout waits for a client to be
+        returned when this many are in use
+
+    idle_timeout
+        clients unused for this many seconds are closed (0 keeps them open)
+
+    checkout_timeout
+        checkout raises `PoolTimeout` after waiting this many seconds for a client (0 waits forever).
+        a thread checking out a second client while holding max_clients would otherwise wait for itself
+    """
+    def __init__(self, dsn, max_clients=8, idle_timeout=60, checkout_timeout=30):
+        self.dsn = dsn
+        self.max_clients = max_clients
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        default = influxdb.InfluxDBClient.from_dsn(dsn)
+        self.default_credentials = (default._username, default._password)
+        default.close()
+        self._lock = threading.Condition()
+        self._idle = {}  # credentials -> [(client, time returned)], most recently returned last
+        self._in_use = {}  # credentials -> number of clients checked out
+        self._pid = os.getpid()
+        self.closed = False
+
+    @contextmanager
+    def client(self, username=None, password=None):
+        """checks out a client for username/password (the dsn's credentials if username is None)
+
+        use as `with pool.client(user, pass) as client:`, the client is returned to the pool afterwards"""
+        credentials = self.default_credentials if username is None else (username, password)
+        client = self._checkout(credentials)
+        try:
+            yield client
+        finally:
+            self._checkin(credentials, client)
+
+    def _checkout(self, credentials):
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked, the parent's sessions must not be shared with it
+                self._idle, self._in_use, self._pid = {}, {}, os.getpid()
+            self._evict_idle()
+            deadline = time.time() + self.checkout_timeout if self.checkout_timeout else None
+            wait_start = None
+            try:
+                while True:
+                    idle = self._idle.get(credentials)
+                    if idle:
+                        client = idle.pop()[0]
+                        break
+                    if self._in_use.get(credentials, 0) < self.max_clients:
+                        client = None
+                        break
+                    if wait_start is None:
+                        metrics.inc('pool_waits_total')
+                        wait_start = time.time()
+                    timeout = None
+                    if deadline is not None:
+                        timeout = deadline - time.time()
+                        if timeout <= 0:
+                            metrics.inc('pool_timeouts_total')
+                            raise PoolTimeout('no InfluxDB client for user {} was free after {} seconds ({} in use)'.format(
+                                credentials[0], self.checkout_timeout, self.max_clients))
+                    self._lock.wait(timeout)
+            finally:
+                if wait_start is not None:
+                    metrics.observe('pool_wait', time.time() - wait_start)
+            self._in_use[credentials] = self._in_use.get(credentials, 0) + 1
+        if client is None:
+            logger.debug('Creating InfluxDB client for user {}'.format(credentials[0]))
+            try:
+                client = TimedInfluxDBClient.from_dsn(self.dsn, username=credentials[0], password=credentials[1])
+            except BaseException:
+                # give the slot back, or a failing dsn would use up the pool
+                with self._lock:
+                    self._release(credentials)
+                raise
+        return client
+
+    def _checkin(self, credentials, client):
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            self._release(credentials)
+            if not self.closed:
+                self._idle.setdefault(credentials, []).append((client, time.time()))
+                return
+        client.close()
+
+    def _release(self, credentials):
+        """frees a checked out slot of credentials, call with the lock held"""
+        self._in_use[credentials] -= 1
+        if not self._in_use[credentials]:
+            del self._in_use[credentials]
+        self._lock.notify_all()
+
+    def close(self):
+        """closes the idle clients, clients checked in afterwards are closed rather than kept"""
+        with self._lock:
+            self.closed = True
+            idle, self._idle = self._idle, {}
+        for clients in idle.values():
+            for client, t in clients:
+                client.close()
+
+    def _evict_idle(self):
+        if not self.idle_timeout:
+            return
+        expired = time.time() - self.idle_timeout
+        for credentials, idle in self._idle.items():
+            keep = [(client, t) for client, t in idle if t >= expired]
+            for client, t in idle:
+                if t < expired:
+                    client.close()
+            if keep:
+                self._idle[credentials] = keep
+            else:
+                del self._idle[credentials]
+
+    def stats(self):
+        """returns a dict of the number of idle and checked out clients, for all credentials"""
+        with self._lock:
+            return dict(idle=sum(len(idle) for idle in self._idle.values()), in_use=sum(self._in_use.values()))
+
+    def size(self, username=None, password=None):
+        """number of clients (idle and checked out) held for username/password"""
+        credentials = self.default_credentials if username is None else (username, password)
+        with self._lock:
+            return len(self._idle.get(credentials, ())) + self._in_use.get(credentials, 0)
@@ -0,0 +1,127 @@
+import csv
+import time
+from io import BytesIO
+from itertools import izip, repeat
+
+from pyslet.py2 import to_text
+
+from feedwriter import calendar_string
+from metrics import metrics
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# property type -> csv formatter, for values that are not None
+_csv_formatters = {
+    u'Edm.Double': lambda v: repr(float(v)),
+    u'Edm.Int64': lambda v: '%d' % v,
+    u'Edm.String': lambda v: to_text(v).encode('utf-8'),
+}
+
+
+def _arrow_types():
+    return {
+        u'Edm.Double': pyarrow.float64(),
+        u'Edm.Int64': pyarrow.int64(),
+        u'Edm.String': pyarrow.string(),
+    }
+
+
+class ExportWriter(object):
+    """writes a whole InfluxDB entity set from the columnar batches of `InfluxDBMeasurement.iterbatches`,
+    in pieces of about a batch
+
+    the columns are timestamp and the selected properties, in property order"""
+    content_type = None
+    extension = None
+
+    def __init__(self, collection):
+        self.collection = collection
+        entity_type = collection.entity_set.entityType
+        select = collection.select
+        self.properties = [p for p in entity_type.Property
+                           if p.name == 'timestamp' or select is None or '*' in select or p.name in select]
+        self.precision = entity_type['timestamp'].precision or 0
+
+    @classmethod
+    def supports(cls, collection):
+        """True if collection can be exported: an InfluxDB measurement whose properties are all of the
+        types influxdbmeta generates"""
+        if not hasattr(collection, 'iterbatches'):
+            return False
+        return all(p.name == 'timestamp' or p.type in _csv_formatters
+                   for p in collection.entity_set.entityType.Property)
+
+
+class CSVExportWriter(ExportWriter):
+    """writes a header row of property names, then a row per point. times are UTC (ex. 2017-01-01T00:00:00Z),
+    nulls are empty"""
+    content_type = 'text/csv; charset=utf-8'
+    extension = 'csv'
+
+    def generate(self):
+        out = BytesIO()
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow([p.name.encode('utf-8') for p in self.properties])
+        for batch in self.collection.iterbatches():
+            start = time.time()
+            count = len(batch['timestamp'])
+            columns = []
+            for p in self.properties:
+                values = batch.get(p.name)
+                if values is None:
+                    columns.append(repeat('', count))
+                elif p.name == 'timestamp':
+                    columns.append([calendar_string(t, self.precision) + 'Z' for t in values])
+                else:
+                    formatter = _csv_formatters[p.type]
+                    columns.append(['' if v is None else formatter(v) for v in values])
+            writer.writerows(izip(*columns))
+            metrics.observe('serialize', time.time() - start, count)
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+        if out.tell():
+            yield out.getvalue()
+
+
+class ArrowExportWriter(ExportWriter):
+    """writes an Arrow IPC stream with a record batch per batch, times are timestamp[us] in UTC. needs pyarrow"""
+    content_type = 'application/vnd.apache.arrow.stream'
+    extension = 'arrow'
+
+    def __init__(self, collection):
+        super(ArrowExportWriter, self).__init__(collection)
+        types = _arrow_types()
+        self.schema = pyarrow.schema([
+            pyarrow.field(p.name, pyarrow.timestamp('us', tz='UTC') if p.name == 'timestamp' else types[p.type])
+            for p in self.properties])
+
+    @classmethod
+    def supports(cls, collection):
+        return pyarrow is not None and super(ArrowExportWriter, cls).supports(collection)
+
+    def generate(self):
+        out = BytesIO()
+        writer = pyarrow.RecordBatchStreamWriter(out, self.schema)
+        for batch in self.collection.iterbatches():
+            start = time.time()
+            count = len(batch['timestamp'])
+            arrays = [pyarrow.array(batch.get(field.name, [None] * count), type=field.type)
+                      for field in self.schema]
+            writer.write_batch(pyarrow.RecordBatch.from_arrays(arrays, self.schema.names))
+            metrics.observe('serialize', time.time() - start, count)
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+        writer.close()
+        yield out.getvalue()
+
+
+#: $format -> writer class
+export_writers = {
+    'csv': CSVExportWriter,
+    'arrow': ArrowExportWriter,
+}
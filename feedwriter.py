@@ -0,0 +1,213 @@
+import datetime
+import json
+import re
+import time
+from xml.sax.saxutils import escape, quoteattr
+
+import pyslet.rfc2396 as uri
+from pyslet.py2 import to_text
+
+from metrics import metrics
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+_non_ascii_re = re.compile(u'[^\x00-\x7f]')
+
+# output is handed to the WSGI server in pieces of about this many bytes
+BUFFER_SIZE = 64 * 1024
+
+ATOM_ENTRY_TEMPLATE = u'''
+\t<entry>
+\t\t<id>{location}</id>
+\t\t<title type="text"/>
+\t\t<updated>{updated}</updated>
+\t\t<link href={href} rel="edit"/>
+\t\t<category scheme="http://schemas.microsoft.com/ado/2007/08/dataservices/scheme" term={type_name}/>
+\t\t<content type="application/xml"><m:properties>{properties}</m:properties></content>
+\t</entry>'''
+
+
+def calendar_string(t, ndp):
+    """formats a `datetime` as pyslet formats an Edm.DateTime with precision ndp (ex. 2017-01-01T00:00:00.000000)"""
+    s = u'%04i-%02i-%02iT%02i:%02i:%02i' % (t.year, t.month, t.day, t.hour, t.minute, t.second)
+    if ndp:
+        s += u'.' + (u'%06i' % t.microsecond)[:ndp].ljust(ndp, u'0')
+    return s
+
+
+def json_ticks(t):
+    """the milliseconds since 1970 of a `datetime`, as pyslet writes an Edm.DateTime in json"""
+    seconds = (t.second + t.microsecond / 1000000.0) + t.minute * 60 + t.hour * 3600
+    return (t - EPOCH).days * 86400000 + int(seconds * 1000)
+
+
+def xml_text(value):
+    """escapes text for xml, with non-ascii characters as character references (as pyslet writes them)"""
+    return _non_ascii_re.sub(lambda m: u'&#x%X;' % ord(m.group()), escape(value))
+
+
+# property type -> (json formatter, atom formatter), for values that are not None
+_formatters = {
+    u'Edm.Double': (lambda v: u'"%s"' % unicode(float(v)),
+                    lambda v: unicode(float(v))),
+    u'Edm.Int64': (lambda v: u'"%d"' % v,
+                   lambda v: u'%d' % v),
+    u'Edm.String': (lambda v: json.dumps(to_text(v)),
+                    lambda v: xml_text(to_text(v))),
+}
+
+
+class FeedWriter(object):
+    """writes a page of an InfluxDB entity set from the rows of the query (see
+    `InfluxDBMeasurement.iterpage_rows`), without building `Entity` objects
+
+    each property's formatting is worked out once from the entity type, and the output is
+    the same as pyslet's serializer, in pieces of about BUFFER_SIZE bytes"""
+    def __init__(self, collection, service_root):
+        self.collection = collection
+        self.service_root = str(service_root)
+        self.location = str(collection.get_location())
+        entity_type = collection.entity_set.entityType
+        self.type_name = entity_type.get_fqname()
+        select = collection.select
+        self.properties = [p for p in entity_type.Property
+                           if select is None or '*' in select or p.name in select]
+        self.precision = entity_type['timestamp'].precision or 0
+
+    @classmethod
+    def supports(cls, collection):
+        """True if collection can be written from its rows: an InfluxDB measurement without $expand,
+        whose properties are all of the types influxdbmeta generates"""
+        if not hasattr(collection, 'iterpage_rows') or collection.expand:
+            return False
+        entity_type = collection.entity_set.entityType
+        return not entity_type.NavigationProperty and all(
+            p.name == 'timestamp' or p.type in _formatters for p in entity_type.Property)
+
+    def entity_location(self, t):
+        key = u"(datetime'{}')".format(calendar_string(t, self.precision))
+        return self.location + uri.escape_data(key.encode('utf-8'))
+
+    def _buffered(self, pieces):
+        out, size = [], 0
+        for piece in pieces:
+            out.append(piece)
+            size += len(piece)
+            if size >= BUFFER_SIZE:
+                yield u''.join(out).encode('utf-8')
+                out, size = [], 0
+        if out:
+            yield u''.join(out).encode('utf-8')
+
+
+class JSONFeedWriter(FeedWriter):
+    def __init__(self, collection, service_root, version=2):
+        super(JSONFeedWriter, self).__init__(collection, service_root)
+        self.version = version
+        self.metadata_template = u'{"__metadata":{"uri":%s,"type":' + json.dumps(self.type_name) + u'}'
+        self.template = []  # (property name, u',"name":', json formatter)
+        for p in self.properties:
+            formatter = None if p.name == 'timestamp' else _formatters[p.type][0]
+            self.template.append((p.name, u',{}:'.format(json.dumps(p.name)), formatter))
+
+    def generate(self):
+        return self._buffered(self._generate())
+
+    def _generate(self):
+        collection = self.collection
+        yield u'{"d":'
+        if self.version < 2:
+            yield u'['
+        else:
+            yield u'{'
+            if collection.inlinecount:
+                yield u'"__count":%s,' % json.dumps(len(collection))
+            yield u'"results":['
+        sep = u''
+        metadata_template, template = self.metadata_template, self.template
+        elapsed, count = 0.0, 0
+        try:
+            for t, row in collection.iterpage_rows():
+                start = time.time()
+                values = dict(row)
+                entry = [sep, metadata_template % json.dumps(self.entity_location(t))]
+                for name, prefix, formatter in template:
+                    entry.append(prefix)
+                    if formatter is None:
+                        entry.append(u'"\\/Date(%i)\\/"' % json_ticks(t))
+                    else:
+                        value = values.get(name)
+                        entry.append(u'null' if value is None else formatter(value))
+                entry.append(u'}')
+                elapsed += time.time() - start
+                count += 1
+                yield u''.join(entry)
+                sep = u','
+        finally:
+            metrics.observe('serialize', elapsed, count)
+        if self.version < 2:
+            yield u']}'
+        else:
+            next_link = collection.get_next_page_location()
+            if next_link is not None:
+                yield u'],"__next":{"uri":%s}}}' % json.dumps(str(next_link))
+            else:
+                yield u']}}'
+
+
+class AtomFeedWriter(FeedWriter):
+    def __init__(self, collection, service_root):
+        super(AtomFeedWriter, self).__init__(collection, service_root)
+        self.template = []  # (property name, u'<d:name>', u'</d:name>', u'<d:name m:null="true"/>', atom formatter)
+        for p in self.properties:
+            formatter = None if p.name == 'timestamp' else _formatters[p.type][1]
+            self.template.append((p.name, u'<d:{}>'.format(p.name), u'</d:{}>'.format(p.name),
+                                  u'<d:{} m:null="true"/>'.format(p.name), formatter))
+
+    def generate(self):
+        return self._buffered(self._generate())
+
+    def _generate(self):
+        collection = self.collection
+        updated = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        yield u'<?xml version="1.0" encoding="UTF-8"?>\n'
+        yield (u'<feed xmlns="http://www.w3.org/2005/Atom" '
+               u'xmlns:d="http://schemas.microsoft.com/ado/2007/08/dataservices" '
+               u'xmlns:m="http://schemas.microsoft.com/ado/2007/08/dataservices/metadata" '
+               u'xml:base={}>'.format(quoteattr(self.service_root)))
+        yield u'\n\t<id>{}</id>'.format(escape(self.location))
+        yield u'\n\t<title type="text">{}</title>'.format(escape(collection.get_title()))
+        yield u'\n\t<updated>{}</updated>'.format(updated)
+        yield u'\n\t<link href={} rel="self"/>'.format(quoteattr(self.location))
+        if collection.inlinecount:
+            yield u'\n\t<m:count>{}</m:count>'.format(len(collection))
+        type_name = quoteattr(self.type_name)
+        template = self.template
+        elapsed, count = 0.0, 0
+        try:
+            for t, row in collection.iterpage_rows():
+                started = time.time()
+                values = dict(row)
+                properties = []
+                for name, start, end, null, formatter in template:
+                    if formatter is None:
+                        properties.extend((start, calendar_string(t, self.precision), end))
+                    else:
+                        value = values.get(name)
+                        if value is None:
+                            properties.append(null)
+                        else:
+                            properties.extend((start, formatter(value), end))
+                location = self.entity_location(t)
+                entry = ATOM_ENTRY_TEMPLATE.format(location=escape(location), updated=updated,
+                                                   href=quoteattr(location), type_name=type_name,
+                                                   properties=u''.join(properties))
+                elapsed += time.time() - started
+                count += 1
+                yield entry
+        finally:
+            metrics.observe('serialize', elapsed, count)
+        next_link = collection.get_next_page_location()
+        if next_link is not None:
+            yield u'\n\t<link href={} rel="next"/>'.format(quoteattr(str(next_link)))
+        yield u'\n</feed>'
@@ -1,7 +1,19 @@
+import hashlib
+import json
+import logging
+import time
+from collections import defaultdict
 from itertools import chain
+from multiprocessing.pool import ThreadPool
 
 from influxdb import InfluxDBClient
 
+logger = logging.getLogger("odata-influxdb")
+
+#: version of the xml generated for a database, kept in schema snapshots. bump it whenever the generated
+#: xml changes, so snapshots written by an older version are regenerated rather than reused
+SNAPSHOT_VERSION = 2
+
 xml_head = """<?xml version="1.0" encoding="utf-8" standalone="yes" ?>
 <edmx:Edmx Version="1.0" xmlns:edmx="http://schemas.microsoft.com/ado/2007/06/edmx"
            xmlns:m="http://schemas.microsoft.com/ado/2007/08/dataservices/metadata"
@@ -52,45 +64,126 @@ def db_name__measurement_name(db_name, m_name):
     )
 
 
+def expand_fields(points):
+    """returns a tuple of dicts where each dict has attributes (name, type, edm_type)
+
+    points are the rows of SHOW FIELD KEYS and/or SHOW TAG KEYS for a single measurement. the fields keep
+    the order of points, so the same schema always gives the same metadata"""
+    fields = []
+    seen = set()
+    for point in points:
+        name = point.get('fieldKey', point.get('tagKey'))
+        influx_type = point.get('fieldType') or 'string'  # tags, and fields of influxdb < 1.0, are strings
+        if (name, influx_type) in seen:
+            continue
+        seen.add((name, influx_type))
+        fields.append(dict(name=name, type=influx_type, edm_type=get_edm_type(influx_type)))
+    return tuple(fields)
+
+
+def schema_fingerprint(schema):
+    """returns a hash of a database schema (see `InfluxDB.database_schema`), used to detect changes"""
+    return hashlib.sha1(json.dumps(schema, sort_keys=True)).hexdigest()
+
+
+def measurement_dicts(db_name, schema):
+    """returns a list of measurement dicts (with their fields) from a database schema"""
+    def m_dict(m):
+        d = dict(name=m['name'])
+        d['db_name'] = db_name
+        d['mangled_db'] = mangle_db_name(db_name)
+        d['mangled_measurement'] = mangle_measurement_name(m['name'])
+        d['mangled_path'] = db_name__measurement_name(db_name, m['name'])
+        d['fields'] = expand_fields(chain(m['fields'], m['tags']))
+        return d
+    return [m_dict(m) for m in schema]
+
+
 class InfluxDB(object):
     def __init__(self, dsn):
+        self.dsn = dsn
         self.client = InfluxDBClient.from_dsn(dsn)
+        self.query_count = 0  #: number of queries sent to influxdb
+        self.query_time = 0.0  #: total seconds spent waiting on those queries
+
+    def query(self, q, database=None):
+        """sends a query to influxdb, keeping count of the queries issued and the time they took"""
+        start = time.time()
+        try:
+            return self.client.query(q, database=database)
+        finally:
+            self.query_count += 1
+            self.query_time += time.time() - start
+
+    def database_schema(self, db_name):
+        """returns a list of measurements in db_name, each a dict with the rows of SHOW FIELD KEYS and
+        SHOW TAG KEYS that belong to it (name, fields, tags)
+
+        measurements, field keys and tag keys are fetched in a single request for the whole database and
+        split by series name, so each measurement only gets its own columns"""
+        measurements_rs, fields_rs, tags_rs = self.query(
+            'SHOW MEASUREMENTS; SHOW FIELD KEYS; SHOW TAG KEYS', database=db_name)
+        fields = defaultdict(list)
+        for (m_name, _), points in fields_rs.items():
+            fields[m_name].extend(points)
+        tags = defaultdict(list)
+        for (m_name, _), points in tags_rs.items():
+            tags[m_name].extend(points)
+        return [dict(name=m['name'], fields=fields[m['name']], tags=tags[m['name']])
+                for m in measurements_rs.get_points()]
 
-    def fields(self, db_name):
-        """returns a tuple of dicts where each dict has attributes (name, type, edm_type)"""
-        fields_rs = self.client.query('SHOW FIELD KEYS', database=db_name)
-        tags_rs = self.client.query('SHOW TAG KEYS', database=db_name)
-        # expand and deduplicate
-        fields = set(tuple(f.items()) for f in chain(*chain(fields_rs, tags_rs)))
-        fields = (dict(
-            name=f[0][1],
-            type='string' if len(f)==1 else f[1][1],
-            edm_type=get_edm_type('string' if len(f)==1 else f[1][1])
-        ) for f in fields)
-        return tuple(fields)
+    def database_measurements(self, db_name):
+        """returns a list of measurement dicts (with their fields) for a single database"""
+        return measurement_dicts(db_name, self.database_schema(db_name))
+
+    def database_entities(self, db_name, cached=None):
+        """returns a snapshot entry for db_name: its schema, the schema fingerprint and the xml for its
+        entity sets and entity types
+
+        if *cached* (a previous entry for the same database) has the same fingerprint it is returned as is"""
+        schema = self.database_schema(db_name)
+        fingerprint = schema_fingerprint(schema)
+        if cached is not None and cached.get('fingerprint') == fingerprint:
+            return cached
+        entity_sets, entity_types = entity_sets_and_types(measurement_dicts(db_name, schema))
+        return dict(fingerprint=fingerprint, measurements=schema,
+                    entity_sets=entity_sets, entity_types=entity_types)
 
     @property
     def measurements(self):
         measurements = []
         for db in self.databases:
-            q = 'SHOW MEASUREMENTS'
-            rs = self.client.query(q, database=db[u'name'])
-
-            def m_dict(m):
-                d = dict(m)
-                d['db_name'] = db['name']
-                d['mangled_db'] = mangle_db_name(db['name'])
-                d['mangled_measurement'] = mangle_measurement_name(m['name'])
-                d['mangled_path'] = db_name__measurement_name(db['name'], m['name'])
-                d['fields'] = self.fields(db['name'])
-                return d
-            measurements.extend(m_dict(m) for m in rs.get_points())
+            measurements.extend(self.database_measurements(db[u'name']))
         return measurements
 
+    def map_databases(self, func, workers=1):
+        """returns [(db_name, func(influxdb, db_name)) for each database], in database order
+
+        with workers > 1 the databases are handled by a pool of `workers` threads, each database with its
+        own client, and the query counts and times of the workers are added to this one"""
+        db_names = [db[u'name'] for db in self.databases]
+        if workers <= 1:
+            return [(db_name, func(self, db_name)) for db_name in db_names]
+
+        def call(db_name):
+            worker = InfluxDB(self.dsn)
+            return func(worker, db_name), worker.query_count, worker.query_time
+
+        pool = ThreadPool(processes=max(1, min(workers, len(db_names))))
+        try:
+            results = pool.map(call, db_names, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        for _, query_count, query_time in results:
+            self.query_count += query_count
+            self.query_time += query_time
+        return [(db_name, result) for db_name, (result, _, _) in zip(db_names, results)]
+
     @property
     def databases(self):
-        rs = self.client.get_list_database()
-        return iter(rs)
+        rs = self.query('SHOW DATABASES')
+        return rs.get_points()
 
 
 def gen_entity_set_xml(m):
@@ -115,24 +208,67 @@ def gen_entity_type_xml(m):
         generate_properties_xml(m))
 
 
-def entity_sets_and_types(db):
+def entity_sets_and_types(measurements):
     """generate xml entries for entity sets (containers) and entity types (with properties)"""
     entity_sets = []
     entity_types = []
-    for m in db.measurements:
+    for m in measurements:
         entity_sets.append(gen_entity_set_xml(m))
         entity_types.append(gen_entity_type_xml(m))
     return entity_sets, entity_types
 
 
-def generate_metadata(dsn):
-    """connect to influxdb, read the structure, and return an edmx xml file string"""
-    i = InfluxDB(dsn)
-    entity_sets, entity_types = entity_sets_and_types(i)
-    output = """{}
+def format_metadata(entity_sets, entity_types):
+    return """{}
     <EntityContainer Name="InfluxDB" m:IsDefaultEntityContainer="true">
     {}
     </EntityContainer>
     {}
     {}""".format(xml_head, '\n'.join(entity_sets), '\n'.join(entity_types), xml_foot)
-    return output
+
+
+def generate_metadata(dsn, workers=1, snapshot=None):
+    """connect to influxdb, read the structure, and return an edmx xml file string
+
+    with workers > 1 the databases are read concurrently, one client per database
+
+    *snapshot* is a dict as returned by `load_snapshot`. Databases with the same schema fingerprint as
+    in the snapshot keep their cached xml, and the snapshot is updated in place with the current schema.
+    the schema of every database is still read, a snapshot only saves regenerating unchanged xml. a
+    snapshot of another `SNAPSHOT_VERSION` is not reused"""
+    start = time.time()
+    i = InfluxDB(dsn)
+    if snapshot is None:
+        databases = i.map_databases(lambda db, db_name: db.database_measurements(db_name), workers)
+        entity_sets, entity_types = entity_sets_and_types(chain(*(m for _, m in databases)))
+        regenerated = len(databases)
+    else:
+        cached = snapshot.get('databases', {}) if snapshot.get('version') == SNAPSHOT_VERSION else {}
+        databases = i.map_databases(lambda db, db_name: db.database_entities(db_name, cached.get(db_name)), workers)
+        regenerated = sum(1 for db_name, entry in databases if entry is not cached.get(db_name))
+        snapshot['databases'] = dict(databases)
+        snapshot['version'] = SNAPSHOT_VERSION
+        entity_sets = list(chain(*(entry['entity_sets'] for _, entry in databases)))
+        entity_types = list(chain(*(entry['entity_types'] for _, entry in databases)))
+    logger.info('Read InfluxDB metadata with {} queries in {:.3f}s ({:.3f}s spent in queries), '
+                '{} database(s) regenerated'.format(i.query_count, time.time() - start, i.query_time, regenerated))
+    return format_metadata(entity_sets, entity_types)
+
+
+def load_snapshot(filename):
+    """reads a schema snapshot written by `save_snapshot`, returns an empty snapshot if there is none"""
+    try:
+        with open(filename, 'rb') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_snapshot(filename, snapshot):
+    with open(filename, 'wb') as f:
+        json.dump(snapshot, f, sort_keys=True)
+
+
+def snapshot_filename(metadata_filename):
+    """the schema snapshot is stored next to the metadata file"""
+    return '{}.snapshot.json'.format(metadata_filename)
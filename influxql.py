@@ -0,0 +1,207 @@
+import datetime
+import decimal
+import re
+
+from pyslet.iso8601 import TimePoint
+from pyslet.odata2.core import BinaryExpression, UnaryExpression, CallExpression, PropertyExpression, \
+    LiteralExpression, Operator, Method
+
+# Operator.and, Operator.or and Operator.not don't resolve in Python
+AND, OR, NOT = getattr(Operator, 'and'), getattr(Operator, 'or'), getattr(Operator, 'not')
+
+comparison_symbols = {
+    Operator.lt: u'<',
+    Operator.le: u'<=',
+    Operator.gt: u'>',
+    Operator.ge: u'>=',
+    Operator.eq: u'=',
+    Operator.ne: u'!=',
+}
+
+# the comparison that is true when the key comparison is false (influxql has no NOT)
+negated_comparisons = {
+    Operator.lt: Operator.ge,
+    Operator.le: Operator.gt,
+    Operator.gt: Operator.le,
+    Operator.ge: Operator.lt,
+    Operator.eq: Operator.ne,
+    Operator.ne: Operator.eq,
+}
+
+arithmetic_symbols = {
+    Operator.add: u'+',
+    Operator.sub: u'-',
+    Operator.mul: u'*',
+    Operator.div: u'/',
+    Operator.mod: u'%',
+}
+
+_regex_special = set(u'\\.+*?()|[]{}^$/')
+
+_duration_units = {
+    'ns': 0.001, 'u': 1, u'\xb5': 1, 'ms': 1000, 's': 1000000, 'm': 60 * 1000000,
+    'h': 3600 * 1000000, 'd': 86400 * 1000000, 'w': 7 * 86400 * 1000000}
+_duration_re = re.compile(u'(\\d+)(ns|u|\xb5|ms|s|m|h|d|w)')
+
+
+def parse_influxdb_duration(duration):
+    """parses an influxdb duration literal (ex. 1h30m) to a `timedelta`, or returns None if it isn't one"""
+    parts = _duration_re.findall(duration or '')
+    if not parts or u''.join(n + unit for n, unit in parts) != duration.strip():
+        return None
+    return datetime.timedelta(microseconds=sum(int(n) * _duration_units[unit] for n, unit in parts))
+
+
+def quote_identifier(name):
+    """quotes a measurement, field or tag name for influxql"""
+    return u'"{}"'.format(name.replace(u'\\', u'\\\\').replace(u'"', u'\\"'))
+
+
+def quote_string(value):
+    """quotes a string literal for influxql"""
+    return u"'{}'".format(value.replace(u'\\', u'\\\\').replace(u"'", u"\\'"))
+
+
+def escape_regex(value):
+    """escapes value to match itself in an influxql /regex/"""
+    return u''.join(u'\\' + c if c in _regex_special else c for c in value)
+
+
+def time_point_to_datetime(t):
+    """converts a pyslet TimePoint to a naive UTC `datetime` (a TimePoint without a zone is taken as UTC,
+    as influxdb does)"""
+    if t.get_zone()[0] is not None:
+        t = t.shift_zone(0)
+    century, year, month, day, hour, minute, second = t.get_calendar_time_point()
+    # rounding can give a whole second (ex. 00.9999996), which the timedelta carries over
+    return datetime.datetime(century * 100 + year, month, day, hour, minute, int(second)) + \
+        datetime.timedelta(microseconds=int(round((second % 1) * 1000000)))
+
+
+def format_literal(value):
+    if value is None:
+        raise NotImplementedError('influxdb does not support comparisons with null')
+    if isinstance(value, bool):
+        return u'true' if value else u'false'
+    if isinstance(value, TimePoint):
+        t = time_point_to_datetime(value)
+        if t.microsecond:
+            return u"'{}'".format(t.strftime('%Y-%m-%d %H:%M:%S.%f'))
+        return u"'{}'".format(t.strftime('%Y-%m-%d %H:%M:%S'))
+    if isinstance(value, (int, long, float)):
+        return repr(value).rstrip('L')
+    if isinstance(value, decimal.Decimal):
+        return unicode(value)
+    if isinstance(value, basestring):
+        return quote_string(value)
+    # guids and binary values are compared as strings
+    return quote_string(unicode(value))
+
+
+def filter_properties(expression):
+    """returns the set of property names used in a $filter expression, other than timestamp"""
+    names = set()
+    if isinstance(expression, PropertyExpression):
+        if expression.name != 'timestamp':
+            names.add(expression.name)
+    for operand in getattr(expression, 'operands', ()):
+        names.update(filter_properties(operand))
+    return names
+
+
+def compile_filter(expression):
+    """compiles a boolean $filter expression (a pyslet `CommonExpression`) to an influxql condition
+
+    supports and, or, not, comparisons (also of arithmetic expressions), boolean properties and
+    startswith, endswith and substringof, which become regex matches. raises NotImplementedError
+    for anything influxdb can't evaluate, including timestamp comparisons under an or and timestamp ne,
+    which influxdb would ignore or answer with no points"""
+    return _compile_condition(expression, False)[0]
+
+
+def _compile_condition(expression, negate, under_or=False):
+    """returns (influxql, operator) for expression (negated if negate), operator is AND or OR if that
+    is the outermost operator of the influxql, so the caller can tell if it needs parentheses.
+    under_or is True inside an OR (after De Morgan)"""
+    if isinstance(expression, UnaryExpression) and expression.operator == NOT:
+        return _compile_condition(expression.operands[0], not negate, under_or)
+    if isinstance(expression, BinaryExpression) and expression.operator in (AND, OR):
+        operator = expression.operator
+        if negate:  # De Morgan
+            operator = OR if operator == AND else AND
+        parts = []
+        for operand in expression.operands:
+            sql, operand_operator = _compile_condition(operand, negate, under_or or operator == OR)
+            if operator == AND and operand_operator == OR:
+                sql = u'({})'.format(sql)
+            parts.append(sql)
+        return (u' AND ' if operator == AND else u' OR ').join(parts), operator
+    if isinstance(expression, BinaryExpression) and expression.operator in comparison_symbols:
+        return _compile_comparison(expression, negate, under_or), None
+    if isinstance(expression, CallExpression):
+        return _compile_match(expression, negate), None
+    if isinstance(expression, PropertyExpression):
+        return u'{} = {}'.format(_compile_operand(expression), u'false' if negate else u'true'), None
+    raise NotImplementedError('unsupported $filter expression: {}'.format(expression))
+
+
+def _compile_comparison(expression, negate, under_or=False):
+    operator = expression.operator
+    left, right = expression.operands
+    if isinstance(right, CallExpression) and isinstance(left, LiteralExpression):
+        left, right = right, left
+    if isinstance(left, CallExpression):
+        # startswith(tag, 'foo') eq true
+        value = right.value.value if isinstance(right, LiteralExpression) else None
+        if operator not in (Operator.eq, Operator.ne) or not isinstance(value, bool):
+            raise NotImplementedError('{} can only be compared with true or false'.format(Method.to_str(left.method)))
+        matches = (operator == Operator.eq) == value
+        return _compile_match(left, negate == matches)
+    if negate:
+        operator = negated_comparisons[operator]
+    if _uses_timestamp(left) or _uses_timestamp(right):
+        if under_or:
+            raise NotImplementedError('timestamp can only be compared in conditions joined by and')
+        if operator == Operator.ne:
+            raise NotImplementedError('timestamp can not be compared with ne')
+    return u'{} {} {}'.format(_compile_operand(left), comparison_symbols[operator], _compile_operand(right))
+
+
+def _uses_timestamp(expression):
+    if isinstance(expression, PropertyExpression):
+        return expression.name == 'timestamp'
+    return any(_uses_timestamp(operand) for operand in getattr(expression, 'operands', ()))
+
+
+def _compile_match(expression, negate):
+    """compiles startswith, endswith and substringof to a regex match"""
+    if expression.method == Method.substringof:
+        literal, subject = expression.operands
+    elif expression.method in (Method.startswith, Method.endswith):
+        subject, literal = expression.operands
+    else:
+        raise NotImplementedError('unsupported $filter function: {}'.format(Method.to_str(expression.method)))
+    if not isinstance(literal, LiteralExpression) or not isinstance(literal.value.value, basestring):
+        raise NotImplementedError('{} needs a string literal'.format(Method.to_str(expression.method)))
+    pattern = escape_regex(literal.value.value)
+    if expression.method == Method.startswith:
+        pattern = u'^' + pattern
+    elif expression.method == Method.endswith:
+        pattern = pattern + u'$'
+    return u'{} {} /{}/'.format(_compile_operand(subject), u'!~' if negate else u'=~', pattern)
+
+
+def _compile_operand(expression):
+    if isinstance(expression, PropertyExpression):
+        if expression.name == 'timestamp':
+            return u'time'
+        return quote_identifier(expression.name)
+    elif isinstance(expression, LiteralExpression):
+        return format_literal(expression.value.value)
+    elif isinstance(expression, BinaryExpression) and expression.operator in arithmetic_symbols:
+        return u'({} {} {})'.format(_compile_operand(expression.operands[0]),
+                                    arithmetic_symbols[expression.operator],
+                                    _compile_operand(expression.operands[1]))
+    elif isinstance(expression, UnaryExpression) and expression.operator == Operator.negate:
+        return u'-{}'.format(_compile_operand(expression.operands[0]))
+    raise NotImplementedError('unsupported $filter operand: {}'.format(expression))
@@ -1,6 +1,6 @@
 from werkzeug.local import Local, LocalManager
 
 local = Local()
-local_manager = LocalManager()
+local_manager = LocalManager([local])
 
 request = local('request')
\ No newline at end of file
@@ -0,0 +1,132 @@
+import threading
+import time
+from contextlib import contextmanager
+
+PREFIX = 'odata_influxdb_'
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+
+class Metrics(object):
+    """thread safe counters and timers, written out in the prometheus text format by `render`
+
+    timers are summaries, with a _sum (seconds) and a _count. collectors are functions called on
+    `render` that return [(name, type, labels dict, value)] for values kept elsewhere (ex. cache stats)"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}  # name -> {label key: value}
+        self._timers = {}  # name -> {label key: [count, sum]}
+        self._collectors = {}  # name -> function
+
+    def inc(self, name, value=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            counter = self._counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + value
+
+    def observe(self, name, seconds, count=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            timer = self._timers.setdefault(name, {}).setdefault(key, [0, 0.0])
+            timer[0] += count
+            timer[1] += seconds
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """times the with block, as `observe(name, seconds, **labels)`"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def collector(self, name, func):
+        """registers func (replacing any collector registered with the same name)"""
+        with self._lock:
+            self._collectors[name] = func
+
+    def get(self, name, **labels):
+        """the value of a counter, or the [count, sum] of a timer, for tests"""
+        key = _label_key(labels)
+        with self._lock:
+            if name in self._timers:
+                return list(self._timers[name].get(key, [0, 0.0]))
+            return self._counters.get(name, {}).get(key, 0)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
+
+    def render(self):
+        with self._lock:
+            counters = dict((name, dict(values)) for name, values in self._counters.items())
+            timers = dict((name, dict((k, list(v)) for k, v in values.items())) for name, values in self._timers.items())
+            collectors = list(self._collectors.values())
+        lines = []
+        for name in sorted(counters):
+            lines.append('# TYPE {}{} counter'.format(PREFIX, name))
+            for key, value in sorted(counters[name].items()):
+                lines.append('{}{}{} {}'.format(PREFIX, name, _format_labels(key), value))
+        for name in sorted(timers):
+            lines.append('# TYPE {}{}_seconds summary'.format(PREFIX, name))
+            for key, (count, total) in sorted(timers[name].items()):
+                lines.append('{}{}_seconds_sum{} {!r}'.format(PREFIX, name, _format_labels(key), total))
+                lines.append('{}{}_seconds_count{} {}'.format(PREFIX, name, _format_labels(key), count))
+        collected = {}
+        for func in collectors:
+            for name, metric_type, labels, value in func():
+                collected.setdefault((name, metric_type), []).append((_label_key(labels), value))
+        for name, metric_type in sorted(collected):
+            lines.append('# TYPE {}{} {}'.format(PREFIX, name, metric_type))
+            for key, value in sorted(collected[name, metric_type]):
+                lines.append('{}{}{} {}'.format(PREFIX, name, _format_labels(key), value))
+        return '\n'.join(lines) + '\n'
+
+
+#: the metrics of this process
+metrics = Metrics()
+
+
+class MetricsMiddleware(object):
+    """Serves `metrics` at path, and times the requests to the wrapped app.
+
+    A request is timed until its response has been written (the app's iterable is closed)."""
+    def __init__(self, app, path='/metrics'):
+        self.wrapped = app
+        self.path = path
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') == self.path:
+            body = metrics.render()
+            start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4'),
+                                      ('Content-Length', str(len(body)))])
+            return [body]
+        start = time.time()
+        statuses = []
+
+        def counting_start_response(status, headers, exc_info=None):
+            statuses[:] = [status.split(' ', 1)[0]]
+            return start_response(status, headers, exc_info)
+
+        app_iter = self.wrapped(environ, counting_start_response)
+        return self.timed(app_iter, start, statuses)
+
+    def timed(self, app_iter, start, statuses):
+        try:
+            for chunk in app_iter:
+                yield chunk
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+            metrics.inc('requests_total', status=statuses[0] if statuses else 'none')
+            metrics.observe('request', time.time() - start)
@@ -0,0 +1,87 @@
+import json
+import logging
+import random
+
+from local import local
+
+logger = logging.getLogger("odata-influxdb.query")
+slow_logger = logging.getLogger("odata-influxdb.slow_query")
+
+#: the most queries listed in an X-Query-Trace header
+MAX_TRACE = 50
+#: the longest X-Query-Trace header value, proxies and clients commonly reject headers over 8KB
+MAX_TRACE_BYTES = 4096
+#: queries longer than this are cut short in the trace
+MAX_TRACE_QUERY = 1024
+
+
+def start_trace():
+    """starts collecting the queries of the current request, see `QueryTraceMiddleware`"""
+    local.query_trace = []
+    return local.query_trace
+
+
+def current_trace():
+    """the trace list of the current request, or None if queries aren't traced.
+
+    read it on the request's thread, and hand it to worker threads"""
+    return getattr(local, 'query_trace', None)
+
+
+def format_trace(trace):
+    """the X-Query-Trace header value: a json list of {"q", "ms", "rows"} in the order the queries finished
+
+    at most MAX_TRACE queries and MAX_TRACE_BYTES bytes are listed, followed by {"omitted": n} if
+    n queries didn't fit"""
+    parts = []
+    size = len('[]') + len('{"omitted":%d},' % len(trace))  # room for the omitted count
+    for entry in trace[:MAX_TRACE]:
+        if len(entry['q']) > MAX_TRACE_QUERY:
+            entry = dict(entry, q=entry['q'][:MAX_TRACE_QUERY] + u'...')
+        part = json.dumps(entry, separators=(',', ':'))  # ascii, so its length is its size in bytes
+        if size + len(part) + 1 > MAX_TRACE_BYTES:
+            break
+        parts.append(part)
+        size += len(part) + 1
+    if len(parts) < len(trace):
+        parts.append('{"omitted":%d}' % (len(trace) - len(parts)))
+    return '[{}]'.format(','.join(parts))
+
+
+class QueryLog(object):
+    """logs each influxdb query with its database, user, duration and row count
+
+    sample_rate
+        fraction (0 to 1) of queries written to the "odata-influxdb.query" logger at level
+
+    slow_query_ms
+        queries taking at least this many milliseconds are always logged to the
+        "odata-influxdb.slow_query" logger, at WARNING. 0 disables the slow query log
+    """
+    def __init__(self, sample_rate=1.0, slow_query_ms=0, level=logging.DEBUG):
+        self.sample_rate = sample_rate
+        self.slow_query_ms = slow_query_ms
+        if not isinstance(level, int):
+            level = logging.getLevelName(level.upper())
+        self.level = level
+
+    def record(self, database, user, q, seconds, rows, trace=None, cached=False):
+        """records a finished query, adding it to trace (a list, see `current_trace`) if given.
+        cached is True for queries answered from the result cache"""
+        ms = round(seconds * 1000, 1)
+        if trace is not None:
+            entry = {'q': q, 'ms': ms, 'rows': rows}
+            if cached:
+                entry['cached'] = True
+            trace.append(entry)
+        slow = self.slow_query_ms and ms >= self.slow_query_ms
+        sampled = self.sample_rate >= 1 or random.random() < self.sample_rate
+        if not (slow or sampled and logger.isEnabledFor(self.level)):
+            return
+        fields = {'database': database, 'user': user, 'duration_ms': ms, 'rows': rows, 'query': q, 'cached': cached}
+        message = u'database={} user={} duration_ms={} rows={}{} query={}'.format(
+            database, user or '-', ms, rows, ' cached=true' if cached else '', json.dumps(q))
+        if slow:
+            slow_logger.warning(message, extra={'query_fields': fields})
+        if sampled:
+            logger.log(self.level, message, extra={'query_fields': fields})
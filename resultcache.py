@@ -0,0 +1,203 @@
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+
+def estimate_size(series):
+    """rough size in bytes of a list of (measurement name, tags, columns, values) result series
+
+    each series is sized from its first row, which is close enough for rows of the same columns"""
+    size = sys.getsizeof(series)
+    for name, tags, columns, values in series:
+        size += sys.getsizeof(values) + 64 * len(tags or ()) + 32 * len(columns)
+        if values:
+            row = values[0]
+            size += len(values) * (sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row))
+    return size
+
+
+class QueryResultCache(object):
+    """least recently used cache of parsed query results, bounded by number of entries and by size
+
+    entries expire after the ttl they are put with. hits and misses are counted, see `stats`"""
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._entries = OrderedDict()  # key -> (value, size, expiry time), least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """returns the value cached for key, or None"""
+        with self._lock:
+            try:
+                value, size, expires = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires <= time.time():
+                self.bytes -= size
+                self.misses += 1
+                return None
+            self._entries[key] = (value, size, expires)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl, size=None):
+        """caches value for ttl seconds, unless it's larger than a tenth of max_bytes"""
+        if size is None:
+            size = estimate_size(value)
+        if ttl <= 0 or size > self.max_bytes // 10:
+            return False
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[key] = (value, size, time.time() + ttl)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """returns a dict of hits, misses, entries and bytes"""
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, entries=len(self._entries), bytes=self.bytes)
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """runs concurrent calls with the same key once, all callers get the result (or exception) of that one call
+
+    `shared` counts the calls that were answered by a call already in flight"""
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class Prefetcher(object):
+    """runs queries in the background, and holds each result for ttl seconds until it's taken
+
+    a result is taken once, by the request it was fetched for. taking a result that is still being
+    fetched waits for it. at most max_entries results are held, further prefetches are dropped.
+    `stats` counts the results taken (hits), the prefetches not taken before they expired (wasted)
+    and the prefetches dropped"""
+    def __init__(self, ttl, workers=2, max_entries=100):
+        self.ttl = ttl
+        self.workers = workers
+        self.max_entries = max_entries
+        self.hits = 0
+        self.wasted = 0
+        self.dropped = 0
+        self._entries = {}  # key -> (_Call, expiry time)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = None
+        self.closed = False
+
+    def _get_pool(self):
+        # threads don't survive a fork, so each (prefork) process creates its own pool
+        if self._pool_pid != os.getpid():
+            self._pool = ThreadPool(processes=self.workers)
+            self._pool_pid = os.getpid()
+        return self._pool
+
+    def start(self, key, func):
+        """starts func() in the background, to be taken with key. returns False if it wasn't started
+        (key is already being prefetched, or too many results are held)"""
+        now = time.time()
+        with self._lock:
+            if self.closed:
+                return False
+            for k, (call, expires) in list(self._entries.items()):
+                if expires <= now:
+                    del self._entries[k]
+                    self.wasted += 1
+            if key in self._entries:
+                return False
+            if len(self._entries) >= self.max_entries:
+                self.dropped += 1
+                return False
+            call = _Call()
+            self._entries[key] = (call, now + self.ttl)
+            pool = self._get_pool()
+        pool.apply_async(self._run, (call, func))
+        return True
+
+    def _run(self, call, func):
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+        finally:
+            call.done.set()
+
+    def take(self, key):
+        """returns the prefetched result for key (waiting for it if it's still running), or None if there
+        is none, it expired or its query failed"""
+        with self._lock:
+            call, expires = self._entries.pop(key, (None, None))
+            if call is None:
+                return None
+            if expires <= time.time():
+                self.wasted += 1
+                return None
+            self.hits += 1
+        call.done.wait()
+        if call.error is not None:
+            return None
+        return call.result
+
+    def close(self):
+        """stops the worker threads once the running prefetches are done, no more are started"""
+        with self._lock:
+            self.closed = True
+            if self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.close()
+
+    def stats(self):
+        """returns a dict of hits, wasted, dropped and entries"""
+        with self._lock:
+            return dict(hits=self.hits, wasted=self.wasted, dropped=self.dropped, entries=len(self._entries))
@@ -0,0 +1,204 @@
+import datetime
+import logging
+import re
+
+from influxql import parse_influxdb_duration, quote_identifier
+
+logger = logging.getLogger("odata-influxdb")
+
+# func -> the aggregate of func's downsampled values that gives the same result as func of the raw points,
+# so a downsampled series can answer for buckets that are a multiple of its own, and across the series of
+# tags it keeps but the query doesn't group by. other funcs (mean, first, last...) are only answered by a
+# downsampled series with the same buckets and tags as the query, one downsampled value per result value
+REAGGREGATE = {'max': 'max', 'min': 'min', 'sum': 'sum', 'count': 'sum'}
+
+_cq_re = re.compile(r'^\s*CREATE\s+CONTINUOUS\s+QUERY\s+.+?\s+ON\s+.+?\s+(?:RESAMPLE\s+.*?\s+)?BEGIN\s+'
+                    r'SELECT\s+(?P<select>.+?)\s+INTO\s+(?P<into>.+?)\s+FROM\s+(?P<source>.+?)\s+'
+                    r'GROUP\s+BY\s+(?P<group_by>.+?)(?:\s+fill\(.*?\))?\s+END\s*$', re.I | re.S)
+_select_item_re = re.compile(r'^(?P<func>\w+)\(\s*(?P<field>\*|"(?:[^"\\]|\\.)+"|\w+)\s*\)'
+                             r'(?:\s+AS\s+(?P<alias>"(?:[^"\\]|\\.)+"|\w+))?$', re.I)
+_identifier_re = re.compile(r'"(?:[^"\\]|\\.)*"|/(?:[^/\\]|\\.)*/|:MEASUREMENT|[^.\s",]+', re.I)
+_time_re = re.compile(r'^time\(\s*(\w+)\s*\)$', re.I)
+
+
+def _unquote(identifier):
+    if identifier.startswith('"'):
+        return identifier[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+    return identifier
+
+
+def _split_top_level(text):
+    """splits text on commas outside of parentheses and quotes"""
+    parts, depth, quoted, start = [], 0, False, 0
+    for i, c in enumerate(text):
+        if c == '"':
+            quoted = not quoted
+        elif not quoted and c == '(':
+            depth += 1
+        elif not quoted and c == ')':
+            depth -= 1
+        elif not quoted and depth == 0 and c == ',':
+            parts.append(text[start:i].strip())
+            start = i + 1
+    parts.append(text[start:].strip())
+    return parts
+
+
+class ContinuousQuery(object):
+    """the parts of a continuous query needed to route queries to the series it writes
+
+    only continuous queries that downsample one measurement (or a /regex/ of measurements into
+    :MEASUREMENT) with single argument aggregates, without a WHERE clause or GROUP BY time offset,
+    are understood, `parse` returns None for others"""
+    def __init__(self, name, database, source, target_rp, target_measurement, interval, tags, fields, star_funcs):
+        self.name = name
+        self.database = database
+        self.source = source  # measurement name, or compiled regex
+        self.target_rp = target_rp  # None for the default retention policy
+        self.target_measurement = target_measurement  # None for :MEASUREMENT
+        self.interval = interval
+        self.tags = tags  # '*' or a frozenset of tag keys kept
+        self.fields = fields  # {(func, source field): target field}
+        self.star_funcs = star_funcs  # funcs applied to * (target field func_field)
+
+    @classmethod
+    def parse(cls, database, name, query):
+        match = _cq_re.match(query)
+        if match is None or re.search(r'\sWHERE\s', match.group('source'), re.I):
+            return None
+        fields, star_funcs = {}, set()
+        for item in _split_top_level(match.group('select')):
+            item_match = _select_item_re.match(item)
+            if item_match is None:
+                return None
+            func = item_match.group('func').lower()
+            if item_match.group('field') == '*':
+                star_funcs.add(func)
+            else:
+                alias = item_match.group('alias')
+                fields[func, _unquote(item_match.group('field'))] = _unquote(alias) if alias else func
+        into = _identifier_re.findall(match.group('into'))
+        source = _identifier_re.findall(match.group('source'))
+        if not 1 <= len(into) <= 3 or not 1 <= len(source) <= 3 or ',' in match.group('source'):
+            return None
+        if len(into) == 3 and _unquote(into[0]) != database:
+            return None  # written to another database
+        target_rp = _unquote(into[-2]) if len(into) > 1 else None
+        target_measurement = None if into[-1].upper() == ':MEASUREMENT' else _unquote(into[-1])
+        if source[-1].startswith('/'):
+            source_measurement = re.compile(source[-1][1:-1])
+        elif target_measurement is None:
+            source_measurement = _unquote(source[-1])
+            target_measurement = source_measurement
+        else:
+            source_measurement = _unquote(source[-1])
+        interval, tags = None, set()
+        for part in _split_top_level(match.group('group_by')):
+            time_match = _time_re.match(part)
+            if time_match is not None:
+                interval = parse_influxdb_duration(time_match.group(1))
+            elif part == '*':
+                tags = '*'
+            elif part.lower().startswith('time('):
+                return None  # offsets shift the buckets
+            elif tags != '*':
+                tags.add(_unquote(part))
+        if interval is None:
+            return None
+        return cls(name, database, source_measurement, target_rp, target_measurement, interval,
+                   tags if tags == '*' else frozenset(tags), fields, star_funcs)
+
+    def reads(self, measurement_name):
+        if isinstance(self.source, basestring):
+            return self.source == measurement_name
+        return self.source.search(measurement_name) is not None
+
+    def target(self, measurement_name):
+        """the measurement written for measurement_name"""
+        return self.target_measurement or measurement_name
+
+    def target_field(self, func, field):
+        if (func, field) in self.fields:
+            return self.fields[func, field]
+        if func in self.star_funcs:
+            return u'{}_{}'.format(func, field)
+        return None
+
+    def keeps_tags(self, tags):
+        return self.tags == '*' or (tags != '*' and self.tags.issuperset(tags))
+
+    def same_tags(self, tags):
+        if self.tags == '*' or tags == '*':
+            return self.tags == tags
+        return self.tags == frozenset(tags)
+
+
+def reaggregate_func(func):
+    """the function applied to the downsampled values of func, see REAGGREGATE"""
+    return REAGGREGATE.get(func.lower(), func)
+
+
+class DownsampleRouter(object):
+    """routes aggregate queries to series written by continuous queries
+
+    continuous_queries
+        list of `ContinuousQuery`
+
+    retention_policies
+        {(database, retention policy): duration}, a duration of None keeps data forever"""
+    def __init__(self, continuous_queries, retention_policies):
+        self.continuous_queries = continuous_queries
+        self.retention_policies = retention_policies
+
+    @classmethod
+    def discover(cls, client):
+        """reads the continuous queries and the retention policies of their databases with client"""
+        continuous_queries = []
+        for (database, _), rows in client.query('SHOW CONTINUOUS QUERIES').items():
+            for row in rows:
+                cq = ContinuousQuery.parse(database, row['name'], row['query'])
+                if cq is None:
+                    logger.info('Not routing to continuous query {} on {}, it is not a simple downsample'.format(
+                        row['name'], database))
+                else:
+                    continuous_queries.append(cq)
+        retention_policies = {}
+        for database in set(cq.database for cq in continuous_queries):
+            rs = client.query(u'SHOW RETENTION POLICIES ON {}'.format(quote_identifier(database)))
+            for rp in rs.get_points():
+                duration = parse_influxdb_duration(rp['duration'])
+                retention_policies[database, rp['name']] = duration or None
+                if rp.get('default'):
+                    retention_policies[database, None] = duration or None
+        logger.info('Found {} continuous queries to route aggregate queries to'.format(len(continuous_queries)))
+        return cls(continuous_queries, retention_policies)
+
+    def route(self, database, measurement_name, func, interval, fields, tags, earliest, now=None,
+              filtered_tags=frozenset()):
+        """returns the continuous query with the coarsest buckets that can answer func(fields) grouped by
+        interval (and tags, '*' for all), filtered on filtered_tags, for data since earliest, or None
+
+        a continuous query can answer if it aggregates every field with func and keeps the tags. when func
+        can be re-aggregated (see REAGGREGATE) its bucket must divide interval, otherwise its bucket must
+        equal interval and it must keep exactly the grouped tags. its retention policy must still hold data
+        from earliest"""
+        func = func.lower()
+        now = now or datetime.datetime.utcnow()
+        wanted_tags = tags if tags == '*' else frozenset(tags).union(filtered_tags)
+        best = None
+        for cq in self.continuous_queries:
+            if cq.database != database or not cq.reads(measurement_name) or cq.interval > interval:
+                continue
+            if func in REAGGREGATE:
+                if interval.total_seconds() % cq.interval.total_seconds():
+                    continue
+            elif cq.interval != interval or not cq.same_tags(tags):
+                continue
+            if not cq.keeps_tags(wanted_tags) or any(cq.target_field(func, f) is None for f in fields):
+                continue
+            duration = self.retention_policies.get((database, cq.target_rp))
+            if duration is not None and earliest < now - duration:
+                continue
+            if best is None or cq.interval > best.interval:
+                best = cq
+        return best
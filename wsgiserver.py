@@ -0,0 +1,135 @@
+import errno
+import logging
+import os
+import signal
+import threading
+from Queue import Queue
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+logger = logging.getLogger("odata-influxdb")
+
+
+class PooledRequestHandler(WSGIRequestHandler):
+    """WSGIRequestHandler with separate timeouts for reading a request and for waiting
+    on the next request of a kept-alive connection.
+
+    `timeout` (the socket timeout while a request is read and answered) and
+    `keep_alive_timeout` are set by `make_server`."""
+    keep_alive_timeout = 5
+    requests_handled = 0
+
+    def handle_one_request(self):
+        if self.requests_handled:
+            # an idle kept-alive connection holds a worker thread, so don't wait long for it
+            self.connection.settimeout(self.keep_alive_timeout)
+        self.raw_requestline = self.rfile.readline()
+        self.connection.settimeout(self.timeout)
+        self.requests_handled += 1
+        if not self.raw_requestline:
+            self.close_connection = 1
+        elif self.parse_request():
+            return self.run_wsgi()
+
+
+class ThreadPoolWSGIServer(BaseWSGIServer):
+    """WSGI server handling each connection on one of a fixed number of worker threads
+
+    The worker threads are started by serve_forever, so a server created before forking
+    gets its own threads in each process."""
+    multithread = True
+    worker_threads = 8
+
+    def __init__(self, *args, **kwargs):
+        super(ThreadPoolWSGIServer, self).__init__(*args, **kwargs)
+        self.requests = Queue()
+        self.workers = []
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def process_request_thread(self):
+        while True:
+            request, client_address = self.requests.get()
+            if request is None:
+                break
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def serve_forever(self, *args, **kwargs):
+        self.workers = [threading.Thread(target=self.process_request_thread, name='wsgi-worker-{}'.format(i))
+                        for i in range(self.worker_threads)]
+        for t in self.workers:
+            t.daemon = True
+            t.start()
+        try:
+            super(ThreadPoolWSGIServer, self).serve_forever(*args, **kwargs)
+        finally:
+            for _ in self.workers:
+                self.requests.put((None, None))
+
+
+def make_server(host, port, app, worker_threads=8, request_timeout=60, keep_alive_timeout=5):
+    """creates a ThreadPoolWSGIServer bound to host:port
+
+    keep_alive_timeout of 0 disables keep-alive (responses use HTTP/1.0)"""
+    handler = type('RequestHandler', (PooledRequestHandler,), dict(
+        timeout=request_timeout or None,
+        keep_alive_timeout=keep_alive_timeout,
+        protocol_version='HTTP/1.1' if keep_alive_timeout else 'HTTP/1.0',
+    ))
+    server = ThreadPoolWSGIServer(host, port, app, handler=handler)
+    server.worker_threads = worker_threads
+    return server
+
+
+def serve_prefork(server, worker_processes, post_fork=None):
+    """forks worker_processes children which all serve on the (already bound) socket of server
+
+    children that exit are replaced. SIGTERM and SIGINT stop the children and return.
+    post_fork is called in each child before it starts serving."""
+    server.multiprocess = True
+    children = set()
+    state = dict(running=True)
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                if post_fork is not None:
+                    post_fork()
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.add(pid)
+
+    def stop(signum, frame):
+        state['running'] = False
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(worker_processes):
+        spawn()
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        children.discard(pid)
+        if state['running']:
+            logger.warning('Worker process {} exited with status {}, restarting it'.format(pid, status))
+            spawn()
+    server.server_close()